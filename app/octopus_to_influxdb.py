@@ -1,119 +1,265 @@
 #!/usr/bin/env python
 
+import asyncio
+import hashlib
+import math
 from configparser import ConfigParser
-from urllib import parse
+from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
+from zoneinfo import ZoneInfo
 
+import ciso8601
 import click
+import httpx
 import maya
-import requests
-from influxdb_client import InfluxDBClient, Point
-from influxdb_client.client.write_api import SYNCHRONOUS
+import numpy as np
+import orjson
+from influxdb_client import InfluxDBClient
+from influxdb_client.client.write_api import WriteOptions
 
-def retrieve_paginated_data(
-        api_key, url, from_date, to_date, page=None
-):
+CACHE_DIR = Path.home() / '.cache' / 'octograph'
+
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+RETRY_TOTAL = 5
+RETRY_BACKOFF = 0.5
+
+# Half-hourly readings only ever land on 48 distinct times of day.
+TIME_OF_DAY = {
+    (hour, minute): f'{hour:02d}:{minute:02d}'
+    for hour in range(24)
+    for minute in (0, 30)
+}
+
+def cache_path(url, params):
+    key = hashlib.sha256(
+        orjson.dumps([url, params], option=orjson.OPT_SORT_KEYS)
+    ).hexdigest()
+    return CACHE_DIR / f'{key}.json'
+
+
+def make_client(api_key):
+    # Pool limits must live on the transport: when a custom transport is
+    # supplied, httpx ignores client-level limits/http2 arguments.
+    return httpx.AsyncClient(
+        auth=(api_key, ''),
+        transport=httpx.AsyncHTTPTransport(
+            retries=5,
+            http2=True,
+            limits=httpx.Limits(
+                max_keepalive_connections=4, max_connections=8
+            ),
+        ),
+    )
+
+
+async def retrieve_paginated_data(client, url, from_date, to_date):
     args = {
         'period_from': from_date,
         'period_to': to_date,
     }
-    if page:
-        args['page'] = page
-    response = requests.get(url, params=args, auth=(api_key, ''))
-    response.raise_for_status()
-    data = response.json()
-    results = data.get('results', [])
-    if data['next']:
-        url_query = parse.urlparse(data['next']).query
-        next_page = parse.parse_qs(url_query)['page'][0]
-        results += retrieve_paginated_data(
-            api_key, url, from_date, to_date, next_page
-        )
+
+    async def fetch_page(page=None):
+        params = dict(args, page=page) if page else args
+
+        # Revalidate against an on-disk copy so unchanged pages cost a
+        # header-only 304 instead of a full body transfer.
+        cached = None
+        path = cache_path(url, params)
+        if path.exists():
+            cached = orjson.loads(path.read_bytes())
+        headers = {}
+        if cached:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        # Transport retries only cover connection failures, so rate
+        # limits and transient 5xx responses are retried here with
+        # exponential backoff before giving up.
+        for attempt in range(RETRY_TOTAL + 1):
+            response = await client.get(url, params=params, headers=headers)
+            if (response.status_code not in RETRY_STATUSES
+                    or attempt == RETRY_TOTAL):
+                break
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+        if cached and response.status_code == 304:
+            return cached['data']
+        response.raise_for_status()
+        data = orjson.loads(response.content)
+
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag or last_modified:
+            CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(orjson.dumps({
+                'etag': etag,
+                'last_modified': last_modified,
+                'data': data,
+            }))
+        return data
+
+    # The first response reports the total count, so the remaining pages
+    # can all be fetched concurrently instead of walking 'next' links
+    # one round trip at a time.
+    data = await fetch_page()
+    results = list(data.get('results', []))
+    if data['next'] and results:
+        pages = math.ceil(data['count'] / len(results))
+        semaphore = asyncio.Semaphore(4)
+
+        async def fetch_bounded(page):
+            async with semaphore:
+                return await fetch_page(page)
+
+        for page_data in await asyncio.gather(*(
+            fetch_bounded(page) for page in range(2, pages + 1)
+        )):
+            results.extend(page_data.get('results', []))
     return results
 
 
+async def retrieve_series(api_key, urls, from_date, to_date):
+    async with make_client(api_key) as client:
+        # Series pointing at the same endpoint share one fetch.
+        fetches = {}
+        for url in urls.values():
+            if url not in fetches:
+                fetches[url] = asyncio.ensure_future(
+                    retrieve_paginated_data(client, url, from_date, to_date)
+                )
+        await asyncio.gather(*fetches.values())
+    return {series: fetches[url].result() for series, url in urls.items()}
+
+
+@lru_cache(maxsize=None)
+def parse_timestamp(timestamp):
+    return ciso8601.parse_datetime(timestamp)
+
+
+@lru_cache(maxsize=None)
+def get_zone(zone_name):
+    return ZoneInfo(zone_name)
+
+
+@lru_cache(maxsize=None)
+def low_rate_interval(date_key, low_start_str, low_end_str, low_zone):
+    zone = get_zone(low_zone)
+    low_start = datetime.fromisoformat(
+        f'{date_key}T{low_start_str}'
+    ).replace(tzinfo=zone)
+    low_end = datetime.fromisoformat(
+        f'{date_key}T{low_end_str}'
+    ).replace(tzinfo=zone)
+    return low_start, low_end
+
+
 def store_series(connection, version, org, bucket, series, metrics, rate_data):
     agile_data = rate_data.get('agile_unit_rates', [])
+    # Key the agile rates by parsed datetimes; aware datetimes hash and
+    # compare by instant, so 'Z' and '+00:00' spellings always match.
     agile_rates = {
-        point['valid_to']: point['value_inc_vat']
+        ciso8601.parse_datetime(point['valid_to']): point['value_inc_vat']
         for point in agile_data
     }
 
+    # The low-rate window only varies by calendar day, so resolve its
+    # configuration once per series rather than per measurement.
+    low_zone = rate_data.get('unit_rate_low_zone')
+    if series != 'gas' and low_zone:
+        low_start_str = rate_data['unit_rate_low_start']
+        low_end_str = rate_data['unit_rate_low_end']
+        zone = get_zone(low_zone)
+
     def active_rate_field(measurement):
         if series == 'gas':
             return 'unit_rate'
-        elif not rate_data['unit_rate_low_zone']:  # no low rate
+        elif not low_zone:  # no low rate
             return 'unit_rate_high'
 
-        low_start_str = rate_data['unit_rate_low_start']
-        low_end_str = rate_data['unit_rate_low_end']
-        low_zone = rate_data['unit_rate_low_zone']
+        measurement_at = parse_timestamp(measurement['interval_start'])
 
-        measurement_at = maya.parse(measurement['interval_start'])
-
-        low_start = maya.when(
-            measurement_at.datetime(to_timezone=low_zone).strftime(
-                f'%Y-%m-%dT{low_start_str}'
-            ),
-            timezone=low_zone
+        date_key = measurement_at.astimezone(zone).strftime('%Y-%m-%d')
+        low_start, low_end = low_rate_interval(
+            date_key, low_start_str, low_end_str, low_zone
         )
-        low_end = maya.when(
-            measurement_at.datetime(to_timezone=low_zone).strftime(
-                f'%Y-%m-%dT{low_end_str}'
-            ),
-            timezone=low_zone
-        )
-        low_period = maya.MayaInterval(low_start, low_end)
 
         return \
-            'unit_rate_low' if measurement_at in low_period \
+            'unit_rate_low' if low_start <= measurement_at < low_end \
             else 'unit_rate_high'
 
-    def fields_for_measurement(measurement):
-        consumption = measurement['consumption']
-        conversion_factor = rate_data.get('conversion_factor', None)
-        if conversion_factor:
-            consumption *= conversion_factor
-        rate = active_rate_field(measurement)
-        rate_cost = rate_data[rate]
-        cost = consumption * rate_cost
-        standing_charge = rate_data['standing_charge'] / 48  # 30 minute reads
-        fields = {
-            'consumption': consumption,
-            'cost': cost,
-            'total_cost': cost + standing_charge,
-        }
-        if agile_data:
-            agile_standing_charge = rate_data['agile_standing_charge'] / 48
-            agile_unit_rate = agile_rates.get(
-                maya.parse(measurement['interval_end']).iso8601(),
-                rate_data[rate]  # cludge, use Go rate during DST changeover
+    # Compute the numeric fields as whole-series numpy arrays instead of
+    # per-measurement Python arithmetic.
+    count = len(metrics)
+    rates = [active_rate_field(measurement) for measurement in metrics]
+    interval_ends = [
+        parse_timestamp(measurement['interval_end']) for measurement in metrics
+    ]
+    consumption = np.fromiter(
+        (measurement['consumption'] for measurement in metrics),
+        dtype=float, count=count
+    )
+    conversion_factor = rate_data.get('conversion_factor', None)
+    if conversion_factor:
+        consumption = consumption * conversion_factor
+    rate_cost_table = {
+        rate: rate_data.get(rate, 0.0)
+        for rate in ('unit_rate', 'unit_rate_low', 'unit_rate_high')
+    }
+    rate_costs = np.fromiter(
+        (rate_cost_table[rate] for rate in rates), dtype=float, count=count
+    )
+    cost = consumption * rate_costs
+    standing_charge = rate_data['standing_charge'] / 48  # 30 minute reads
+    total_cost = cost + standing_charge
+
+    # Format the field sets straight from the column arrays; per-row
+    # field dicts would only be re-serialized by the client anyway.
+    if agile_data:
+        agile_standing_charge = rate_data['agile_standing_charge'] / 48
+        agile_unit_rates = np.fromiter(
+            (
+                agile_rates.get(
+                    end_at,
+                    rate_cost  # cludge, use Go rate during DST changeover
+                )
+                for end_at, rate_cost in zip(interval_ends, rate_costs)
+            ),
+            dtype=float, count=count
+        )
+        agile_cost = agile_unit_rates * consumption
+        agile_total_cost = agile_cost + agile_standing_charge
+        field_sets = [
+            f'consumption={c},cost={co},total_cost={t},'
+            f'agile_rate={ar},agile_cost={ac},agile_total_cost={at}'
+            for c, co, t, ar, ac, at in zip(
+                consumption.tolist(), cost.tolist(), total_cost.tolist(),
+                agile_unit_rates.tolist(), agile_cost.tolist(),
+                agile_total_cost.tolist(),
             )
-            agile_cost = agile_unit_rate * consumption
-            fields.update({
-                'agile_rate': agile_unit_rate,
-                'agile_cost': agile_cost,
-                'agile_total_cost': agile_cost + agile_standing_charge,
-            })
-        return fields
-
-    def tags_for_measurement(measurement):
-        period = maya.parse(measurement['interval_end'])
-        time = period.datetime().strftime('%H:%M')
-        return {
-            'active_rate': active_rate_field(measurement),
-            'time_of_day': time,
-        }
+        ]
+    else:
+        field_sets = [
+            f'consumption={c},cost={co},total_cost={t}'
+            for c, co, t in zip(
+                consumption.tolist(), cost.tolist(), total_cost.tolist()
+            )
+        ]
 
-    measurements = [
-        {
-            'measurement': series,
-            'tags': tags_for_measurement(measurement),
-            'time': measurement['interval_end'],
-            'fields': fields_for_measurement(measurement),
-        }
-        for measurement in metrics
-    ]
-    connection.write(bucket, org, measurements)
+    # One pass per measurement: the active rate is reused from the array
+    # pass above and interval_end is parsed exactly once per row.
+    lines = []
+    for i, end_at in enumerate(interval_ends):
+        time_of_day = TIME_OF_DAY.get(
+            (end_at.hour, end_at.minute)
+        ) or end_at.strftime('%H:%M')
+        timestamp = int(end_at.timestamp() * 1e9)
+        lines.append(
+            f'{series},active_rate={rates[i]},time_of_day={time_of_day} '
+            f'{field_sets[i]} {timestamp}'
+        )
+    connection.write(bucket, org, lines)
 
 
 @click.command()
@@ -137,8 +283,11 @@ def cmd(config_file, from_date, to_date):
             url=config.get('influxdb', 'url', fallback="http://localhost:8086"),
             token=config.get('influxdb', 'token', fallback=""),
             org=org,
+            enable_gzip=True,
         )
-    write_api = influx.write_api(write_options=SYNCHRONOUS)
+    write_api = influx.write_api(
+        write_options=WriteOptions(batch_size=1000, flush_interval=5_000)
+    )
 
     api_key = config.get('octopus', 'api_key')
     if not api_key:
@@ -200,33 +349,25 @@ def cmd(config_file, from_date, to_date):
     from_iso = maya.when(from_date, timezone=timezone).iso8601()
     to_iso = maya.when(to_date, timezone=timezone).iso8601()
 
-    click.echo(
-        f'Retrieving electricity data for {from_iso} until {to_iso}...',
-        nl=False
-    )
-    e_consumption = retrieve_paginated_data(
-        api_key, e_url, from_iso, to_iso
-    )
-    click.echo(f' {len(e_consumption)} readings.')
-    # click.echo(
-    #     f'Retrieving Agile rates for {from_iso} until {to_iso}...',
-    #     nl=False
-    # )
-    # rate_data['electricity']['agile_unit_rates'] = retrieve_paginated_data(
-    #     api_key, agile_url, from_iso, to_iso
-    # )
-    click.echo(f' {len(rate_data["electricity"]["agile_unit_rates"])} rates.')
-    store_series(write_api, influx_version, org, bucket, 'electricity', e_consumption, rate_data['electricity'])
-
-    click.echo(
-        f'Retrieving gas data for {from_iso} until {to_iso}...',
-        nl=False
-    )
-    g_consumption = retrieve_paginated_data(
-        api_key, g_url, from_iso, to_iso
-    )
-    click.echo(f' {len(g_consumption)} readings.')
-    store_series(write_api, influx_version, org, bucket, 'gas', g_consumption, rate_data['gas'])
+    tasks = {
+        'electricity': e_url,
+        'gas': g_url,
+    }
+    if agile_url:
+        tasks['agile'] = agile_url
+
+    click.echo(f'Retrieving data for {from_iso} until {to_iso}...')
+    results = asyncio.run(retrieve_series(api_key, tasks, from_iso, to_iso))
+    for series, readings in results.items():
+        click.echo(f'  {series}: {len(readings)} readings.')
+
+    rate_data['electricity']['agile_unit_rates'] = results.get('agile', [])
+    store_series(write_api, influx_version, org, bucket, 'electricity', results['electricity'], rate_data['electricity'])
+    store_series(write_api, influx_version, org, bucket, 'gas', results['gas'], rate_data['gas'])
+
+    # Flush any batches still queued by the background writer.
+    write_api.close()
+    influx.close()
 
 
 if __name__ == '__main__':